@@ -1,8 +1,18 @@
 from pathlib import Path
+import os
 
 def get_config():
     return {
-        "batch_size": 8,
+        "batch_size": 16,
+        "accum_steps": 1,
+        "num_workers": min(4, (os.cpu_count() or 2) // 2),
+        "pretokenize": True,
+        "pad_multiple": 32,
+        "compile": True,
+        "teacher_cache": True,
+        "teacher_top_k": 64,
+        "gradient_checkpointing": True,
+        "prune": True,
         "num_epochs": 20,
         "lr": 10**-4,
         "seq_len": 350,
@@ -14,6 +24,7 @@ def get_config():
         "model_basename": "tmodel_",
         "preload": "latest",
         "tokenizer_file": "tokenizer_{0}.json",
+        "token_folder": "tokens",
         "experiment_name": "runs/tmodel"
     }
 
@@ -22,6 +33,10 @@ def get_weights_file_path(config, epoch: str):
     model_filename = f"{config['model_basename']}{epoch}.pt"
     return str(Path('.') / model_folder / model_filename)
 
+# Folder with the pre-tokenized corpus written by pretokenize.py
+def get_token_cache_folder(config):
+    return str(Path('.') / f"{config['datasource']}_{config['token_folder']}")
+
 # Find the latest weights file in the weights folder
 def latest_weights_file_path(config):
     model_folder = f"{config['datasource']}_{config['model_folder']}"
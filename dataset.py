@@ -1,89 +1,240 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, Subset
+import numpy as np
+
+import json
+import math
+from pathlib import Path
+
+class TokenCache:
+    # Token ids written by pretokenize.py, memory-mapped from disk and indexed by the row of the raw dataset
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        with open(self.folder / 'meta.json') as f:
+            meta = json.load(f)
+        self.num_samples = meta['num_samples']
+        self.max_len_src = meta['max_len_src']
+        self.max_len_tgt = meta['max_len_tgt']
+        # Hashes of the tokenizers that produced the ids, None for caches written before they were recorded
+        self.tokenizer_hashes = [meta.get('tokenizer_src'), meta.get('tokenizer_tgt')]
+        self.offsets = {side: np.load(self.folder / f'{side}_offsets.npy') for side in ('src', 'tgt')}
+        # Opened lazily so every DataLoader worker maps the files itself
+        self.tokens = {}
+
+    @staticmethod
+    def exists(folder):
+        return (Path(folder) / 'meta.json').exists()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tokens'] = {}
+        return state
+
+    def lengths(self, side):
+        # Number of tokens of every sample, without reading the token files
+        return np.diff(self.offsets[side])
+
+    def ids(self, side, idx):
+        if side not in self.tokens:
+            self.tokens[side] = np.memmap(self.folder / f'{side}_tokens.bin', dtype=np.int32, mode='r')
+        offsets = self.offsets[side]
+        # Copy out of the read-only map so the ids can be turned into tensors
+        return self.tokens[side][offsets[idx]:offsets[idx + 1]].astype(np.int64)
+
+class TeacherCache:
+    # Top-k teacher logits of every decoder position, written once by train.py so distillation does not rerun the teacher.
+    # Stored flat in token cache order: sample i owns the len(tgt_i) + 1 positions starting at tgt_offsets[i] + i
+
+    def __init__(self, folder, token_cache):
+        self.folder = Path(folder)
+        with open(self.folder / 'teacher_meta.json') as f:
+            meta = json.load(f)
+        self.top_k = meta['top_k']
+        self.offsets = TeacherCache.position_offsets(token_cache)
+        # Opened lazily so every DataLoader worker maps the files itself
+        self.arrays = {}
+
+    @staticmethod
+    def position_offsets(token_cache):
+        offsets = token_cache.offsets['tgt']
+        return offsets + np.arange(len(offsets))
+
+    @staticmethod
+    def exists(folder, token_cache, top_k, teacher_hash):
+        # Only valid for the same corpus, tokenizers, top_k and teacher weights
+        meta_path = Path(folder) / 'teacher_meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return (meta['top_k'] == top_k and meta['num_positions'] == TeacherCache.position_offsets(token_cache)[-1]
+                and meta.get('tokenizers') == token_cache.tokenizer_hashes and meta.get('teacher_hash') == teacher_hash)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def topk(self, idx):
+        if not self.arrays:
+            num_positions = int(self.offsets[-1])
+            self.arrays['values'] = np.memmap(self.folder / 'teacher_values.bin', dtype=np.float16, mode='r', shape=(num_positions, self.top_k))
+            self.arrays['indices'] = np.memmap(self.folder / 'teacher_indices.bin', dtype=np.int32, mode='r', shape=(num_positions, self.top_k))
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        # (len(tgt) + 1, top_k) logits and the vocabulary ids they belong to
+        return np.array(self.arrays['values'][start:end]), self.arrays['indices'][start:end].astype(np.int64)
 
 class BilingualDataset(Dataset):
 
-    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len):
+    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len, token_cache=None):
         super().__init__()
         self.seq_len = seq_len
 
         self.ds = ds
+        # The token cache is indexed by the row of the raw dataset, so remember which rows a split refers to
+        self.token_cache = token_cache
+        self.rows = ds.indices if isinstance(ds, Subset) else range(len(ds))
+        # Set by train.py once the teacher logits have been precomputed
+        self.teacher_cache = None
         self.tokenizer_src = tokenizer_src
         self.tokenizer_tgt = tokenizer_tgt
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
 
-        self.sos_token = torch.tensor([tokenizer_tgt.token_to_id("[SOS]")], dtype=torch.int64)
-        self.eos_token = torch.tensor([tokenizer_tgt.token_to_id("[EOS]")], dtype=torch.int64)
-        self.pad_token = torch.tensor([tokenizer_tgt.token_to_id("[PAD]")], dtype=torch.int64)
-
     def __len__(self):
         return len(self.ds)
 
+    def lengths(self):
+        # Padded length each sample needs, the longer of the source (<s> and </s>) and target (<s> or </s>) sides
+        rows = np.asarray(self.rows)
+        return np.maximum(self.token_cache.lengths('src')[rows] + 2, self.token_cache.lengths('tgt')[rows] + 1)
+
     def __getitem__(self, idx):
+        # Tokenization and padding happen per batch in BilingualCollate
         src_target_pair = self.ds[idx]
-        src_text = src_target_pair['translation'][self.src_lang]
-        tgt_text = src_target_pair['translation'][self.tgt_lang]
+        item = {
+            "src_text": src_target_pair['translation'][self.src_lang],
+            "tgt_text": src_target_pair['translation'][self.tgt_lang],
+        }
+        if self.token_cache is not None:
+            item["src_ids"] = self.token_cache.ids('src', self.rows[idx])
+            item["tgt_ids"] = self.token_cache.ids('tgt', self.rows[idx])
+        if self.teacher_cache is not None:
+            item["teacher_values"], item["teacher_indices"] = self.teacher_cache.topk(self.rows[idx])
+        return item
+
+class BilingualCollate:
+    # Turns a list of BilingualDataset items into padded tensors.
+    # Items without cached ids are tokenized with one encode_batch call per side instead of one encode call per sentence
+
+    # Every batch is padded to its own longest sentence, rounded up to a multiple of pad_multiple and capped at seq_len.
+    # The (seq_len, seq_len) decoder_mask is only built when asked for, decoding with causal attention does not need it
+
+    def __init__(self, tokenizer_src, tokenizer_tgt, seq_len, pad_multiple=8, build_decoder_mask=False):
+        self.tokenizer_src = tokenizer_src
+        self.tokenizer_tgt = tokenizer_tgt
+        self.seq_len = seq_len
+        self.pad_multiple = pad_multiple
+        self.build_decoder_mask = build_decoder_mask
+
+        self.sos_id = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_id = tokenizer_tgt.token_to_id("[EOS]")
+        self.pad_id = tokenizer_tgt.token_to_id("[PAD]")
+
+    def __call__(self, batch):
+        src_texts = [item["src_text"] for item in batch]
+        tgt_texts = [item["tgt_text"] for item in batch]
 
         # Transform the text into tokens
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
-
-        # Add sos, eos and padding to each sentence
-        enc_num_padding_tokens = self.seq_len - len(enc_input_tokens) - 2  # We will add <s> and </s>
-        # We will only add <s>, and </s> only on the label
-        dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) - 1
-
-        # Make sure the number of padding tokens is not negative. If it is, the sentence is too long
-        if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
-            raise ValueError("Sentence is too long")
-
-        # Add <s> and </s> token
-        encoder_input = torch.cat(
-            [
-                self.sos_token,
-                torch.tensor(enc_input_tokens, dtype=torch.int64),
-                self.eos_token,
-                torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Add only <s> token
-        decoder_input = torch.cat(
-            [
-                self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Add only </s> token
-        label = torch.cat(
-            [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                self.eos_token,
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Double check the size of the tensors to make sure they are all seq_len long
-        assert encoder_input.size(0) == self.seq_len
-        assert decoder_input.size(0) == self.seq_len
-        assert label.size(0) == self.seq_len
-
-        return {
-            "encoder_input": encoder_input,  # (seq_len)
-            "decoder_input": decoder_input,  # (seq_len)
-            "encoder_mask": (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(), # (1, 1, seq_len)
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)), # (1, seq_len) & (1, seq_len, seq_len),
-            "label": label,  # (seq_len)
-            "src_text": src_text,
-            "tgt_text": tgt_text,
+        if "src_ids" in batch[0]:
+            src_ids = [item["src_ids"] for item in batch]
+            tgt_ids = [item["tgt_ids"] for item in batch]
+        else:
+            src_ids = [encoding.ids for encoding in self.tokenizer_src.encode_batch(src_texts)]
+            tgt_ids = [encoding.ids for encoding in self.tokenizer_tgt.encode_batch(tgt_texts)]
+
+        # Encoder and decoder share one padded length, which keeps the number of distinct batch shapes small
+        longest = max(max(len(ids) for ids in src_ids) + 2, max(len(ids) for ids in tgt_ids) + 1)
+        seq_len = min(self.seq_len, math.ceil(longest / self.pad_multiple) * self.pad_multiple)
+
+        encoder_input = torch.full((len(batch), seq_len), self.pad_id, dtype=torch.int64)
+        decoder_input = torch.full((len(batch), seq_len), self.pad_id, dtype=torch.int64)
+        label = torch.full((len(batch), seq_len), self.pad_id, dtype=torch.int64)
+
+        for i, (enc_input_tokens, dec_input_tokens) in enumerate(zip(src_ids, tgt_ids)):
+            # Make sure there is room for <s> and </s>. If there is not, the sentence is too long
+            if len(enc_input_tokens) + 2 > self.seq_len or len(dec_input_tokens) + 1 > self.seq_len:
+                raise ValueError("Sentence is too long")
+
+            # Add <s> and </s> token
+            encoder_input[i, 0] = self.sos_id
+            encoder_input[i, 1:len(enc_input_tokens) + 1] = torch.as_tensor(enc_input_tokens)
+            encoder_input[i, len(enc_input_tokens) + 1] = self.eos_id
+
+            # Add only <s> token
+            decoder_input[i, 0] = self.sos_id
+            decoder_input[i, 1:len(dec_input_tokens) + 1] = torch.as_tensor(dec_input_tokens)
+
+            # Add only </s> token
+            label[i, :len(dec_input_tokens)] = torch.as_tensor(dec_input_tokens)
+            label[i, len(dec_input_tokens)] = self.eos_id
+
+        output = {
+            "encoder_input": encoder_input,  # (batch, seq_len)
+            "decoder_input": decoder_input,  # (batch, seq_len)
+            "encoder_mask": (encoder_input != self.pad_id).unsqueeze(1).unsqueeze(1).int(), # (batch, 1, 1, seq_len)
+            "label": label,  # (batch, seq_len)
+            "src_text": src_texts,
+            "tgt_text": tgt_texts,
         }
+
+        if self.build_decoder_mask:
+            output["decoder_mask"] = (decoder_input != self.pad_id).unsqueeze(1).unsqueeze(1).int() & causal_mask(seq_len) # (batch, 1, 1, seq_len) & (1, seq_len, seq_len)
+
+        if "teacher_values" in batch[0]:
+            # Padding positions keep zeros, the distillation loss ignores them
+            top_k = batch[0]["teacher_values"].shape[1]
+            teacher_values = torch.zeros((len(batch), seq_len, top_k), dtype=torch.float16)
+            teacher_indices = torch.zeros((len(batch), seq_len, top_k), dtype=torch.int64)
+            for i, item in enumerate(batch):
+                teacher_values[i, :len(item["teacher_values"])] = torch.from_numpy(item["teacher_values"])
+                teacher_indices[i, :len(item["teacher_indices"])] = torch.from_numpy(item["teacher_indices"])
+            output["teacher_values"] = teacher_values  # (batch, seq_len, top_k)
+            output["teacher_indices"] = teacher_indices  # (batch, seq_len, top_k)
+
+        return output
+
+class BucketBatchSampler(Sampler):
+    # Batches samples of similar length together so little of each batch is padding.
+    # Samples are sorted by length (ties broken randomly), cut into batches and the batch order is shuffled every epoch.
+    # With several processes every rank takes an equal share of the batches
+
+    def __init__(self, lengths, batch_size, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        # Every rank draws the same permutation, so they agree on the batches
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = order[np.argsort(self.lengths[order], kind='stable')]
+        batches = [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches[self.rank::self.num_replicas][:len(self)])
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size) // self.num_replicas
     
 def causal_mask(size):
     mask = torch.triu(torch.ones((1, size, size)), diagonal=1).type(torch.int)
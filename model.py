@@ -1,5 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantStub, DeQuantStub
+from torch.utils.checkpoint import checkpoint
 import math
 
 class LayerNormalization(nn.Module):
@@ -26,10 +29,13 @@ class FeedForwardBlock(nn.Module):
         self.linear_1 = nn.Linear(d_model, d_ff) # w1 and b1
         self.dropout = nn.Dropout(dropout)
         self.linear_2 = nn.Linear(d_ff, d_model) # w2 and b2
+        # Identity in float, mark where activations enter and leave int8 after static quantization
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
 
     def forward(self, x):
         # (batch, seq_len, d_model) --> (batch, seq_len, d_ff) --> (batch, seq_len, d_model)
-        return self.linear_2(self.dropout(torch.relu(self.linear_1(x))))
+        return self.dequant(self.linear_2(self.dropout(torch.relu(self.linear_1(self.quant(x))))))
 
 class InputEmbeddings(nn.Module):
 
@@ -66,8 +72,9 @@ class PositionalEncoding(nn.Module):
         # Register the positional encoding as a buffer
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
+    def forward(self, x, start=0):
+        # start is the position of the first token of x, used when decoding one token at a time
+        x = x + (self.pe[:, start:start + x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
         return self.dropout(x)
 
 class ResidualConnection(nn.Module):
@@ -82,6 +89,9 @@ class ResidualConnection(nn.Module):
 
 class MultiHeadAttentionBlock(nn.Module):
 
+    # Set to True to run the explicit attention and keep self.attention_scores for visualization
+    store_attention_scores = False
+
     def __init__(self, d_model: int, h: int, dropout: float) -> None:
         super().__init__()
         self.d_model = d_model # Embedding vector size
@@ -95,6 +105,12 @@ class MultiHeadAttentionBlock(nn.Module):
         self.w_v = nn.Linear(d_model, d_model, bias=False) # Wv
         self.w_o = nn.Linear(d_model, d_model, bias=False) # Wo
         self.dropout = nn.Dropout(dropout)
+        # Identity in float, one QuantStub per projection input so each gets its own activation range
+        self.quant_q = QuantStub()
+        self.quant_k = QuantStub()
+        self.quant_v = QuantStub()
+        self.quant_o = QuantStub()
+        self.dequant = DeQuantStub()
 
     @staticmethod
     def attention(query, key, value, mask, dropout: nn.Dropout):
@@ -104,7 +120,8 @@ class MultiHeadAttentionBlock(nn.Module):
         attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
         if mask is not None:
             # Write a very low value (indicating -inf) to the positions where mask == 0
-            attention_scores.masked_fill_(mask == 0, -1e9)
+            # Use the lowest value of the dtype so the fill also fits in float16 under autocast
+            attention_scores.masked_fill_(mask == 0, torch.finfo(attention_scores.dtype).min)
         attention_scores = attention_scores.softmax(dim=-1) # (batch, h, seq_len, seq_len) # Apply softmax
         if dropout is not None:
             attention_scores = dropout(attention_scores)
@@ -112,18 +129,32 @@ class MultiHeadAttentionBlock(nn.Module):
         # return attention scores which can be used for visualization
         return (attention_scores @ value), attention_scores
 
-    def forward(self, q, k, v, mask):
-        query = self.w_q(q) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        key = self.w_k(k) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        value = self.w_v(v) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-
+    def split_heads(self, x):
         # (batch, seq_len, d_model) --> (batch, seq_len, h, d_k) --> (batch, h, seq_len, d_k)
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return x.view(x.shape[0], x.shape[1], self.h, self.d_k).transpose(1, 2)
+
+    def project_kv(self, k, v):
+        # (batch, seq_len, d_model) --> (batch, h, seq_len, d_k)
+        return self.split_heads(self.dequant(self.w_k(self.quant_k(k)))), self.split_heads(self.dequant(self.w_v(self.quant_v(v))))
+
+    def forward(self, q, k, v, mask, is_causal=False):
+        key, value = self.project_kv(k, v)
+        return self.attend(q, key, value, mask, is_causal=is_causal)
+
+    def attend(self, q, key, value, mask, is_causal=False):
+        # key and value are already projected and split into heads, so they can be cached between calls
+        query = self.split_heads(self.dequant(self.w_q(self.quant_q(q)))) # (batch, seq_len, d_model) --> (batch, h, seq_len, d_k)
 
         # Calculate attention
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if self.store_attention_scores:
+            if is_causal:
+                mask = torch.tril(torch.ones(query.shape[2], key.shape[2], dtype=torch.bool, device=query.device))
+            x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        else:
+            # With is_causal and no mask this can use a fused kernel that never materialises the (seq_len, seq_len) scores.
+            # torch 2.0 falls back to the math kernel whenever attn_mask is given, such as the padding mask of the encoder
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask.bool() if mask is not None else None,
+                                               dropout_p=self.dropout.p if self.training else 0.0, is_causal=is_causal)
         
         # Combine all the heads together
         # (batch, h, seq_len, d_k) --> (batch, seq_len, h, d_k) --> (batch, seq_len, d_model)
@@ -131,7 +162,7 @@ class MultiHeadAttentionBlock(nn.Module):
 
         # Multiply by Wo
         # (batch, seq_len, d_model) --> (batch, seq_len, d_model)  
-        return self.w_o(x)
+        return self.dequant(self.w_o(self.quant_o(x)))
 
 class EncoderBlock(nn.Module):
 
@@ -152,12 +183,15 @@ class Encoder(nn.Module):
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalization(features)
-
-    def forward(self, x, mask, print_shapes=False):
-        for i, layer in enumerate(self.layers):
-            x = layer(x, mask)
-            if print_shapes:
-                print(f"Encoder Layer {i + 1} output shape: {x.shape}")
+        # Recompute the layer activations during backward instead of keeping them, see Transformer.set_gradient_checkpointing
+        self.gradient_checkpointing = False
+
+    def forward(self, x, mask):
+        for layer in self.layers:
+            if self.gradient_checkpointing and self.training:
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
         return self.norm(x)
 
 class DecoderBlock(nn.Module):
@@ -170,10 +204,35 @@ class DecoderBlock(nn.Module):
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
 
     def forward(self, x, encoder_output, src_mask, tgt_mask):
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
+        # Without a tgt_mask the self-attention is plain causal attention, which the fused kernel handles without a mask tensor
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask, is_causal=tgt_mask is None))
         x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
         x = self.residual_connections[2](x, self.feed_forward_block)
         return x
+
+    def step(self, x, encoder_output, src_mask, past_kv=None):
+        # x: (batch, 1, d_model) holds only the newest target position
+        # past_kv holds the self-attention keys/values of the previous positions and the cross-attention keys/values
+        if past_kv is None:
+            self_kv = None
+            cross_kv = self.cross_attention_block.project_kv(encoder_output, encoder_output)
+        else:
+            self_kv, cross_kv = past_kv
+
+        def self_attention(x):
+            nonlocal self_kv
+            key, value = self.self_attention_block.project_kv(x, x)
+            if self_kv is not None:
+                key = torch.cat([self_kv[0], key], dim=2)
+                value = torch.cat([self_kv[1], value], dim=2)
+            self_kv = (key, value)
+            # The newest position may attend to every cached position, so no causal mask is needed
+            return self.self_attention_block.attend(x, key, value, None)
+
+        x = self.residual_connections[0](x, self_attention)
+        x = self.residual_connections[1](x, lambda x: self.cross_attention_block.attend(x, cross_kv[0], cross_kv[1], src_mask))
+        x = self.residual_connections[2](x, self.feed_forward_block)
+        return x, (self_kv, cross_kv)
     
 class Decoder(nn.Module):
 
@@ -181,23 +240,35 @@ class Decoder(nn.Module):
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalization(features)
+        # Recompute the layer activations during backward instead of keeping them, see Transformer.set_gradient_checkpointing
+        self.gradient_checkpointing = False
 
-    def forward(self, x, encoder_output, src_mask, tgt_mask, print_shapes=False):
-        for i, layer in enumerate(self.layers):
-            x = layer(x, encoder_output, src_mask, tgt_mask)
-            if print_shapes:
-                print(f"Decoder Layer {i + 1} output shape: {x.shape}")
+    def forward(self, x, encoder_output, src_mask, tgt_mask):
+        for layer in self.layers:
+            if self.gradient_checkpointing and self.training:
+                x = checkpoint(layer, x, encoder_output, src_mask, tgt_mask, use_reentrant=False)
+            else:
+                x = layer(x, encoder_output, src_mask, tgt_mask)
         return self.norm(x)
 
+    def step(self, x, encoder_output, src_mask, past_kv=None):
+        present_kv = []
+        for i, layer in enumerate(self.layers):
+            x, layer_kv = layer.step(x, encoder_output, src_mask, past_kv[i] if past_kv is not None else None)
+            present_kv.append(layer_kv)
+        return self.norm(x), present_kv
+
 class ProjectionLayer(nn.Module):
 
     def __init__(self, d_model, vocab_size) -> None:
         super().__init__()
         self.proj = nn.Linear(d_model, vocab_size)
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
 
     def forward(self, x) -> None:
         # (batch, seq_len, d_model) --> (batch, seq_len, vocab_size)
-        return self.proj(x)
+        return self.dequant(self.proj(self.quant(x)))
     
 class Transformer(nn.Module):
 
@@ -211,38 +282,41 @@ class Transformer(nn.Module):
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
 
-    def encode(self, src, src_mask, print_shapes=False):
+    def encode(self, src, src_mask):
         # (batch, seq_len, d_model)
         src = self.src_embed(src)
-        if print_shapes:
-            print(f"Source Embeddings shape: {src.shape}")
         src = self.src_pos(src)
-        if print_shapes:
-            print(f"Source after Positional Encoding shape: {src.shape}")
-        encoder_output = self.encoder(src, src_mask)
-        if print_shapes:
-            print(f"Encoder output shape: {encoder_output.shape}")
-        return encoder_output
+        return self.encoder(src, src_mask)
     
-    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor, print_shapes=False):
+    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
         # (batch, seq_len, d_model)
         tgt = self.tgt_embed(tgt)
-        if print_shapes:
-            print(f"Target Embeddings shape: {tgt.shape}")
         tgt = self.tgt_pos(tgt)
-        if print_shapes:
-            print(f"Target after Positional Encoding shape: {tgt.shape}")
-        decoder_output = self.decoder(tgt, encoder_output, src_mask, tgt_mask)
-        if print_shapes:
-            print(f"Decoder output shape: {decoder_output.shape}")
-        return decoder_output
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+
+    def decode_step(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, past_kv=None):
+        # tgt: (batch, 1) is the newest target token, past_kv is the cache returned by the previous call
+        start = past_kv[0][0][0].size(2) if past_kv is not None else 0
+        tgt = self.tgt_pos(self.tgt_embed(tgt), start=start)
+        # (batch, 1, d_model)
+        return self.decoder.step(tgt, encoder_output, src_mask, past_kv)
     
-    def project(self, x, print_shapes=False):
+    def forward(self, src: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
+        # Full teacher-forced pass, so wrappers such as DistributedDataParallel see a single forward call
+        encoder_output = self.encode(src, src_mask)
+        decoder_output = self.decode(encoder_output, src_mask, tgt, tgt_mask)
+        # (batch, seq_len, vocab_size)
+        return self.project(decoder_output)
+
+    def project(self, x):
         # (batch, seq_len, vocab_size)
-        output = self.projection_layer(x)
-        if print_shapes:
-            print(f"Projected output shape: {output.shape}")
-        return output
+        return self.projection_layer(x)
+
+    def set_gradient_checkpointing(self, enabled: bool=True):
+        # Trade one extra forward of every encoder/decoder block per training step for much less activation memory.
+        # Only applies in training mode, evaluation and decoding are unaffected
+        self.encoder.gradient_checkpointing = enabled
+        self.decoder.gradient_checkpointing = enabled
     
 def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, N: int=6, h: int=8, dropout: float=0.1, d_ff: int=2048) -> Transformer:
     # Create the embedding layers
@@ -0,0 +1,47 @@
+from config import get_config, get_token_cache_folder
+
+from datasets import load_dataset
+from tokenizers import Tokenizer
+import numpy as np
+
+import hashlib
+import json
+from pathlib import Path
+
+def tokenizer_hash(tokenizer):
+    # Identifies the vocabulary and settings of a tokenizer, so a cache built with another tokenizer is not reused
+    return hashlib.sha256(tokenizer.to_str().encode()).hexdigest()
+
+def pretokenize(config, ds_raw, tokenizer_src, tokenizer_tgt, batch_size=1000):
+    # Tokenize the whole corpus once and write the ids of each side into a flat tokens.bin plus an offsets index,
+    # so the training dataset can memory-map them instead of running the tokenizer in every __getitem__
+    folder = Path(get_token_cache_folder(config))
+    folder.mkdir(parents=True, exist_ok=True)
+
+    max_len = {}
+    for side, lang, tokenizer in (('src', config['lang_src'], tokenizer_src), ('tgt', config['lang_tgt'], tokenizer_tgt)):
+        lengths = []
+        with open(folder / f'{side}_tokens.bin', 'wb') as f:
+            for start in range(0, len(ds_raw), batch_size):
+                rows = ds_raw[start:start + batch_size]['translation']
+                encodings = tokenizer.encode_batch([row[lang] for row in rows])
+                np.concatenate([np.asarray(encoding.ids, dtype=np.int32) for encoding in encodings]).tofile(f)
+                lengths.extend(len(encoding.ids) for encoding in encodings)
+
+        # Sample i owns tokens[offsets[i]:offsets[i + 1]]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(folder / f'{side}_offsets.npy', offsets)
+        max_len[side] = max(lengths)
+
+    with open(folder / 'meta.json', 'w') as f:
+        json.dump({'num_samples': len(ds_raw), 'max_len_src': max_len['src'], 'max_len_tgt': max_len['tgt'],
+                   'tokenizer_src': tokenizer_hash(tokenizer_src), 'tokenizer_tgt': tokenizer_hash(tokenizer_tgt)}, f)
+
+if __name__ == '__main__':
+    config = get_config()
+    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+    tokenizer_src = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_src']))))
+    tokenizer_tgt = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_tgt']))))
+    pretokenize(config, ds_raw, tokenizer_src, tokenizer_tgt)
+    print(f"Pre-tokenized corpus saved to {get_token_cache_folder(config)}")
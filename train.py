@@ -1,17 +1,29 @@
 from model import build_transformer, build_student_transformer
-from dataset import BilingualDataset, causal_mask
-from config import get_config, get_weights_file_path, latest_weights_file_path
+from dataset import BilingualDataset, BilingualCollate, BucketBatchSampler, TeacherCache, TokenCache, causal_mask
+from config import get_config, get_weights_file_path, latest_weights_file_path, get_token_cache_folder
+from pretokenize import pretokenize, tokenizer_hash
 
 from datasets import load_dataset
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.utils.prune as prune
+import torch._dynamo
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
 from torch.optim.lr_scheduler import LambdaLR
+import numpy as np
 
 import warnings
+import contextlib
+import math
 from tqdm import tqdm
 import os
+import json
+import hashlib
+import shutil
 from pathlib import Path
 
 from tokenizers import Tokenizer
@@ -21,67 +33,103 @@ from tokenizers.pre_tokenizers import Whitespace
 
 import torchmetrics
 from torch.utils.tensorboard import SummaryWriter
-print_shapes1 = False
+from torchinfo import summary
 
-def knowledge_distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+def knowledge_distillation_loss(student_logits, teacher_logits, labels, temperature, alpha, loss_fn, pad_idx, teacher_indices=None):
     """Compute the knowledge distillation loss between the student and teacher."""
-    distillation_loss = nn.KLDivLoss(reduction='batchmean')(torch.log_softmax(student_logits / temperature, dim=-1),
-                                                            torch.softmax(teacher_logits / temperature, dim=-1)) * (temperature ** 2)
-    ce_loss = nn.CrossEntropyLoss()(student_logits, labels)
+    # Padding positions have no target, so they are left out of the distillation term as well
+    non_pad = (labels != pad_idx).float()
+    student_log_probs = F.log_softmax(student_logits / temperature, dim=-1)
+    if teacher_indices is not None:
+        # Only the teacher's top-k logits were kept, compare both distributions on those tokens
+        student_log_probs = student_log_probs.gather(-1, teacher_indices)
+    kl = F.kl_div(student_log_probs, F.softmax(teacher_logits.float() / temperature, dim=-1), reduction='none').sum(dim=-1)
+    distillation_loss = (kl * non_pad).sum() / non_pad.sum().clamp(min=1) * (temperature ** 2)
+    # loss_fn already ignores padding and applies label smoothing
+    ce_loss = loss_fn(student_logits, labels)
     return alpha * ce_loss + (1 - alpha) * distillation_loss
 
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, print_shapes=False):
+def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, eos_check_interval=8):
     sos_idx = tokenizer_tgt.token_to_id('[SOS]')
     eos_idx = tokenizer_tgt.token_to_id('[EOS]')
 
-    encoder_output = model.encode(source, source_mask, print_shapes=print_shapes)
-    decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(device)
-    while True:
-        if decoder_input.size(1) == max_len:
+    encoder_output = model.encode(source, source_mask)
+    # Allocate the whole output once on the device and write each new token in place
+    decoder_input = torch.full((1, max_len), sos_idx, dtype=source.dtype, device=device)
+    # Keys and values of the generated prefix, so each step only runs the decoder on the newest token
+    past_kv = None
+    length = 1
+    while length < max_len:
+        out, past_kv = model.decode_step(encoder_output, source_mask, decoder_input[:, length - 1:length], past_kv)
+        prob = model.project(out[:, -1])
+        _, next_word = torch.max(prob, dim=1)
+        decoder_input[:, length] = next_word
+        length += 1
+
+        # Checking for EOS needs a device to host sync, so only do it every few steps
+        if length % eos_check_interval == 0 and (decoder_input[0, :length] == eos_idx).any():
             break
 
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask, print_shapes=print_shapes)
-        prob = model.project(out[:, -1], print_shapes=print_shapes)
+    tokens = decoder_input[0, :length]
+    # Drop anything generated after the first EOS
+    eos_positions = (tokens == eos_idx).nonzero()
+    if len(eos_positions) > 0:
+        tokens = tokens[:eos_positions[0, 0] + 1]
+    return tokens
+
+def greedy_decode_batch(model, source, source_mask, max_len, sos_idx, eos_idx, device):
+    # Run the encoder once for the whole batch and decode every row in lockstep
+    encoder_output = model.encode(source, source_mask)
+    decoder_input = torch.full((source.size(0), 1), sos_idx, dtype=source.dtype, device=device)
+    finished = torch.zeros(source.size(0), dtype=torch.bool, device=device)
+    past_kv = None
+    while decoder_input.size(1) < max_len:
+        out, past_kv = model.decode_step(encoder_output, source_mask, decoder_input[:, -1:], past_kv)
+        prob = model.project(out[:, -1])
         _, next_word = torch.max(prob, dim=1)
-        decoder_input = torch.cat(
-            [decoder_input, torch.empty(1, 1).type_as(source).fill_(next_word.item()).to(device)], dim=1
-        )
+        # Rows that already produced EOS keep emitting EOS
+        next_word = next_word.masked_fill(finished, eos_idx)
+        decoder_input = torch.cat([decoder_input, next_word.unsqueeze(1)], dim=1)
 
-        if next_word == eos_idx:
+        finished |= next_word == eos_idx
+        if finished.all():
             break
 
-    return decoder_input.squeeze(0)
+    return decoder_input
 
-def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples=2):
-    global print_shapes1
+def get_validation_metrics(device):
+    # Built once per training run and reset after every validation, keyed by the name used in the logs
+    return {
+        'cer': torchmetrics.CharErrorRate().to(device),
+        'wer': torchmetrics.WordErrorRate().to(device),
+        'BLEU': torchmetrics.BLEUScore().to(device),
+    }
+
+def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples=2, metrics=None, prefix='validation'):
     model.eval()
-    count = 0
 
     source_texts = []
     expected = []
     predicted = []
 
-    try:
-        with os.popen('stty size', 'r') as console:
-            _, console_width = console.read().split()
-            console_width = int(console_width)
-    except:
-        console_width = 80
+    # get the console window width, falling back to 80 columns when stdout is not a terminal
+    console_width = shutil.get_terminal_size(fallback=(80, 24)).columns
 
-    with torch.no_grad():
-        for batch in validation_ds:
-            count += 1
-            encoder_input = batch["encoder_input"].to(device)
-            encoder_mask = batch["encoder_mask"].to(device)
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
 
-            assert encoder_input.size(0) == 1, "Batch size must be 1 for validation"
+    # Decode all the examples as a single batch instead of one sentence at a time
+    validation_batches = DataLoader(validation_ds.dataset, batch_size=num_examples, shuffle=True, collate_fn=validation_ds.collate_fn)
+
+    with torch.no_grad():
+        batch = next(iter(validation_batches))
+        encoder_input = batch["encoder_input"].to(device)
+        encoder_mask = batch["encoder_mask"].to(device)
 
-            model_out = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device, print_shapes=print_shapes1)
+        model_out = greedy_decode_batch(model, encoder_input, encoder_mask, max_len, sos_idx, eos_idx, device)
 
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
+        for source_text, target_text, tokens in zip(batch["src_text"], batch["tgt_text"], model_out):
+            model_out_text = tokenizer_tgt.decode(tokens.detach().cpu().numpy())
 
             source_texts.append(source_text)
             expected.append(target_text)
@@ -92,24 +140,15 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
             print_msg(f"{f'TARGET: ':>12}{target_text}")
             print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
 
-            if count == num_examples:
-                print_msg('-'*console_width)
-                break
+        print_msg('-'*console_width)
     
     if writer:
-        metric = torchmetrics.CharErrorRate()
-        cer = metric(predicted, expected)
-        writer.add_scalar('validation cer', cer, global_step)
-        writer.flush()
-
-        metric = torchmetrics.WordErrorRate()
-        wer = metric(predicted, expected)
-        writer.add_scalar('validation wer', wer, global_step)
-        writer.flush()
-
-        metric = torchmetrics.BLEUScore()
-        bleu = metric(predicted, expected)
-        writer.add_scalar('validation BLEU', bleu, global_step)
+        if metrics is None:
+            metrics = get_validation_metrics(device)
+        for name, metric in metrics.items():
+            metric.update(predicted, expected)
+            writer.add_scalar(f'{prefix} {name}', metric.compute(), global_step)
+            metric.reset()
         writer.flush()
 
 def get_all_sentences(ds, lang):
@@ -128,37 +167,188 @@ def get_or_build_tokenizer(config, ds, lang):
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer
 
+def get_or_build_token_cache(config, ds, tokenizer_src, tokenizer_tgt):
+    folder = get_token_cache_folder(config)
+    # Rebuild when the corpus or either tokenizer changed since the cache was written
+    tokenizer_hashes = [tokenizer_hash(tokenizer_src), tokenizer_hash(tokenizer_tgt)]
+    token_cache = TokenCache(folder) if TokenCache.exists(folder) else None
+    if token_cache is None or token_cache.num_samples != len(ds) or token_cache.tokenizer_hashes != tokenizer_hashes:
+        pretokenize(config, ds, tokenizer_src, tokenizer_tgt)
+        token_cache = TokenCache(folder)
+    return token_cache
+
+def state_dict_hash(model):
+    # Identifies a set of weights, so caches computed from a model can tell when it changed
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+def amp_context(device, amp_dtype, use_amp):
+    # torch 2.0 rejects autocast on MPS even when disabled, so only enter it when mixed precision is on
+    return torch.autocast(device_type=device.type, dtype=amp_dtype) if use_amp else contextlib.nullcontext()
+
+def get_or_build_teacher_cache(config, teacher_model, teacher_forward, token_cache, collate_fn, device, amp_dtype, use_amp):
+    # Cache the top-k logits of the frozen teacher for the whole corpus, so it runs once instead of once per epoch.
+    # The cache records a hash of the teacher weights and is rebuilt whenever the teacher changes
+    folder = Path(get_token_cache_folder(config))
+    top_k = config.get('teacher_top_k', 64)
+    teacher_hash = state_dict_hash(teacher_model)
+    distributed = dist.is_available() and dist.is_initialized()
+    if TeacherCache.exists(folder, token_cache, top_k, teacher_hash):
+        return TeacherCache(folder, token_cache)
+
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if distributed else (0, 1)
+    offsets = TeacherCache.position_offsets(token_cache)
+    shape = (int(offsets[-1]), top_k)
+
+    # Only the first rank writes the files, so concurrent writers from other nodes cannot corrupt them.
+    # Every rank reads them afterwards, so like the token cache this needs a filesystem shared by all the nodes
+    if rank == 0:
+        # Invalidate the old cache before overwriting it, a rebuild interrupted half way must not look complete
+        (folder / 'teacher_meta.json').unlink(missing_ok=True)
+        values = np.memmap(folder / 'teacher_values.bin', dtype=np.float16, mode='w+', shape=shape)
+        indices = np.memmap(folder / 'teacher_indices.bin', dtype=np.int32, mode='w+', shape=shape)
+
+    # Sorting by length keeps the padding of every batch small
+    lengths = np.maximum(token_cache.lengths('src') + 2, token_cache.lengths('tgt') + 1)
+    order = np.argsort(lengths, kind='stable')
+    batches = [order[i:i + config['batch_size']] for i in range(0, len(order), config['batch_size'])]
+
+    with torch.no_grad(), amp_context(device, amp_dtype, use_amp):
+        # Every rank runs one batch per round and sends its top-k to the first rank
+        for first in tqdm(range(0, len(batches), world_size), desc="Precomputing teacher logits", disable=rank != 0):
+            result = None
+            if first + rank < len(batches):
+                rows = batches[first + rank]
+                batch = collate_fn([{"src_text": "", "tgt_text": "", "src_ids": token_cache.ids('src', row), "tgt_ids": token_cache.ids('tgt', row)} for row in rows])
+                teacher_logits = teacher_forward(batch['encoder_input'].to(device), batch['encoder_mask'].to(device), batch['decoder_input'].to(device), None)
+                top_values, top_indices = teacher_logits.float().topk(top_k, dim=-1)
+                result = (rows, top_values.half().cpu().numpy(), top_indices.int().cpu().numpy())
+            results = [result]
+            if distributed:
+                results = [None] * world_size if rank == 0 else None
+                dist.gather_object(result, results, dst=0)
+            if rank != 0:
+                continue
+            for result in results:
+                if result is None:
+                    continue
+                rows, top_values, top_indices = result
+                for j, row in enumerate(rows):
+                    start, end = offsets[row], offsets[row + 1]
+                    values[start:end] = top_values[j, :end - start]
+                    indices[start:end] = top_indices[j, :end - start]
+
+    # The meta file marks the cache as complete, the other ranks wait for it before reading
+    if rank == 0:
+        values.flush()
+        indices.flush()
+        del values, indices
+        with open(folder / 'teacher_meta.json', 'w') as f:
+            json.dump({'top_k': top_k, 'num_positions': shape[0], 'tokenizers': token_cache.tokenizer_hashes, 'teacher_hash': teacher_hash}, f)
+    if distributed:
+        dist.barrier()
+    return TeacherCache(folder, token_cache)
+
 def get_ds(config):
     ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
 
+    # When training with several processes, only the first rank builds the tokenizers, the others load them from disk.
+    # The tokenizers, token cache and teacher cache are read from the working directory, which all the nodes must share
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed and dist.get_rank() != 0:
+        dist.barrier()
     tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
     tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+    # Without the token cache the sentences are tokenized on the fly, one batch at a time
+    token_cache = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt) if config.get('pretokenize', True) else None
+    if distributed and dist.get_rank() == 0:
+        dist.barrier()
 
     train_ds_size = int(0.9 * len(ds_raw))
     val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
+    # Every rank must agree on the split, so seed it when training with several processes
+    generator = torch.Generator().manual_seed(config.get('seed', 0)) if distributed else torch.default_generator
+    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size], generator=generator)
 
-    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_cache=token_cache)
+    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_cache=token_cache)
 
-    max_len_src = 0
-    max_len_tgt = 0
+    if token_cache is not None:
+        print(f'Max length of source sentence: {token_cache.max_len_src}')
+        print(f'Max length of target sentence: {token_cache.max_len_tgt}')
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
-
-    print(f'Max length of source sentence: {max_len_src}')
-    print(f'Max length of target sentence: {max_len_tgt}')
+    collate_fn = BilingualCollate(tokenizer_src, tokenizer_tgt, config['seq_len'], pad_multiple=config.get('pad_multiple', 8))
     
 
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # Prepare batches in worker processes into pinned memory so host to device copies can overlap with compute.
+    # Tokenizing on the fly stays in the main process: the tokenizers were already used here, so after a fork they
+    # turn their Rust parallelism off, and encode_batch is fastest with its own threads
+    num_workers = config.get('num_workers', 0) if token_cache is not None else 0
+    loader_kwargs = {'pin_memory': torch.cuda.is_available(), 'num_workers': num_workers}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    if token_cache is not None:
+        # Batch sentences of similar length together, each rank sees its own share of the batches
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if distributed else (1, 0)
+        train_sampler = BucketBatchSampler(train_ds.lengths(), config['batch_size'], num_replicas=num_replicas, rank=rank, seed=config.get('seed', 0))
+        train_dataloader = DataLoader(train_ds, batch_sampler=train_sampler, collate_fn=collate_fn, **loader_kwargs)
+    else:
+        # Each rank sees its own shard of the training set
+        train_sampler = DistributedSampler(train_ds) if distributed else None
+        train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=train_sampler is None, sampler=train_sampler, collate_fn=collate_fn, **loader_kwargs)
+    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True, collate_fn=collate_fn)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
+def prune_2_4(model):
+    # 2:4 structured sparsity: in every group of 4 consecutive input weights of a Linear only the 2 largest are kept.
+    # This is the pattern Ampere sparse tensor cores accelerate, and it stacks with the int8 quantization that follows
+    for module in model.modules():
+        if isinstance(module, nn.Linear) and module.in_features % 4 == 0:
+            weight = module.weight.detach()
+            groups = weight.abs().reshape(-1, 4)
+            mask = torch.zeros_like(groups).scatter_(1, groups.topk(2, dim=1).indices, 1.0).reshape(weight.shape)
+            prune.custom_from_mask(module, name='weight', mask=mask)
+            # Bake the mask into the weight so the state dict keeps its original keys
+            prune.remove(module, 'weight')
+    return model
+
+def get_quantized_engine():
+    # x86/fbgemm on Intel and AMD CPUs, qnnpack on ARM (e.g. Apple Silicon)
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError(f"No quantized engine available, supported engines: {torch.backends.quantized.supported_engines}")
+
+def quantize_static(model, dataloader, num_batches=100):
+    # Quantize the weights and activations of every Linear to int8, calibrating the activation ranges on a few batches.
+    # The QuantStub/DeQuantStub pairs in model.py fence the Linears, everything else keeps running in float
+    engine = get_quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = model.to('cpu').eval()
+    model.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    for module in model.modules():
+        if isinstance(module, nn.Embedding):
+            # Embeddings only support weight-only quantization
+            module.qconfig = torch.ao.quantization.float_qparams_weight_only_qconfig
+    torch.ao.quantization.prepare(model, inplace=True)
+
+    with torch.no_grad():
+        for i, batch in enumerate(dataloader):
+            if i == num_batches:
+                break
+            model(batch['encoder_input'], batch['encoder_mask'], batch['decoder_input'], None)
+
+    torch.ao.quantization.convert(model, inplace=True)
+
+    # Run the converted model once so a broken conversion fails here rather than in whoever loads the weights
+    with torch.no_grad():
+        model(batch['encoder_input'], batch['encoder_mask'], batch['decoder_input'], None)
+    return model
+
 def get_model(config, vocab_src_len, vocab_tgt_len):
     model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config['seq_len'], d_model=config['d_model'])
     return model
@@ -168,27 +358,50 @@ def get_model_distillation(config, vocab_src_len, vocab_tgt_len):
     return model
 
 def train_model(config):
-    device = "cuda" if torch.cuda.is_available() else "mps" if torch.has_mps or torch.backends.mps.is_available() else "cpu"
-    print("Using device:", device)
-    if (device == 'cuda'):
-        print(f"Device name: {torch.cuda.get_device_name(device.index)}")
-        print(f"Device memory: {torch.cuda.get_device_properties(device.index).total_memory / 1024 ** 3} GB")
-    elif (device == 'mps'):
-        print(f"Device name: <mps>")
+    # torchrun sets LOCAL_RANK, in which case every process drives one GPU
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        device = torch.device(f'cuda:{local_rank}')
+        torch.cuda.set_device(device)
+        is_main_process = dist.get_rank() == 0
+        if is_main_process:
+            print(f"Using {dist.get_world_size()} processes with DistributedDataParallel")
     else:
-        print("NOTE: If you have a GPU, consider using it for training.")
-    device = torch.device(device)
+        device = "cuda" if torch.cuda.is_available() else "mps" if torch.has_mps or torch.backends.mps.is_available() else "cpu"
+        print("Using device:", device)
+        if (device == 'cuda'):
+            print(f"Device name: {torch.cuda.get_device_name(device.index)}")
+            print(f"Device memory: {torch.cuda.get_device_properties(device.index).total_memory / 1024 ** 3} GB")
+        elif (device == 'mps'):
+            print(f"Device name: <mps>")
+        else:
+            print("NOTE: If you have a GPU, consider using it for training.")
+        device = torch.device(device)
+        is_main_process = True
 
     Path(f"{config['datasource']}_{config['model_folder']}").mkdir(parents=True, exist_ok=True)
 
     train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    # Resolve tokenizer lookups once, they cross into Rust on every call
+    vocab_src_size = tokenizer_src.get_vocab_size()
+    vocab_tgt_size = tokenizer_tgt.get_vocab_size()
+
     # Load the teacher model
-    teacher_model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    teacher_model = get_model(config, vocab_src_size, vocab_tgt_size).to(device)
+    teacher_model.eval()
+    if distributed:
+        # Every rank has to distill from the same teacher, take the weights of the first rank
+        for tensor in teacher_model.state_dict().values():
+            dist.broadcast(tensor, src=0)
     
     # Define and initialize the student model
-    student_model = get_model_distillation(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    student_model = get_model_distillation(config, vocab_src_size, vocab_tgt_size).to(device)
+    # Checkpointing the student frees enough activation memory for the doubled batch size in the config
+    student_model.set_gradient_checkpointing(config.get('gradient_checkpointing', False))
     
-    writer = SummaryWriter(config['experiment_name'])
+    writer = SummaryWriter(config['experiment_name']) if is_main_process else None
 
     optimizer = torch.optim.Adam(student_model.parameters(), lr=config['lr'], eps=1e-9)
 
@@ -206,51 +419,112 @@ def train_model(config):
     else:
         print('No model to preload, starting from scratch')
 
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_idx, label_smoothing=0.1).to(device)
     
     temperature = config.get('temperature', 2.0)
     alpha = config.get('alpha', 0.7)
+    accum_steps = config.get('accum_steps', 1)
+
+    # Mixed precision: bfloat16 where supported (no loss scaling needed), otherwise float16 with a GradScaler
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
+
+    metrics = get_validation_metrics(device) if is_main_process else None
+
+    # Only the student is trained, the teacher runs without gradients on every rank and is not wrapped
+    train_student = DDP(student_model, device_ids=[device.index], gradient_as_bucket_view=True) if distributed else student_model
+
+    # The teacher is frozen, so its encode/decode/project run as one compiled graph replayed with CUDA graphs
+    use_compile = config.get('compile', True) and device.type == 'cuda'
+    if use_compile:
+        # Batches are padded to their own length, allow one compiled graph per padded length
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, math.ceil(config['seq_len'] / config.get('pad_multiple', 8)) + 1)
+    teacher_forward = torch.compile(teacher_model, mode='reduce-overhead', fullgraph=True) if use_compile else teacher_model
+    # torch 2.0 dynamo fails with an internal error when tracing into non-reentrant checkpointing,
+    # so a checkpointed student runs eagerly and trades the compiled speed for its smaller activation memory
+    compile_student = use_compile and not config.get('gradient_checkpointing', False)
+    student_forward = torch.compile(train_student) if compile_student else train_student
+
+    # With the token cache in place, run the teacher over the corpus once and train from its cached top-k logits
+    token_cache = train_dataloader.dataset.token_cache
+    teacher_cache = None
+    if config.get('teacher_cache', True) and token_cache is not None:
+        teacher_cache = get_or_build_teacher_cache(config, teacher_model, teacher_forward, token_cache, train_dataloader.collate_fn, device, amp_dtype, use_amp)
+        # Set before the first iteration so the persistent workers get it
+        train_dataloader.dataset.teacher_cache = teacher_cache
+        # The teacher is not needed anymore, free its memory for the student
+        del teacher_model, teacher_forward
+
+    if is_main_process:
+        # Print the layer by layer output shapes of the student once, on a batch of the training set
+        batch = next(iter(train_dataloader))
+        # torchinfo cannot measure a None input, so the causal tgt_mask goes through the forward kwargs instead
+        summary(student_model, input_data=[batch['encoder_input'].to(device), batch['encoder_mask'].to(device), batch['decoder_input'].to(device)],
+                tgt_mask=None, depth=4, col_names=('input_size', 'output_size', 'num_params'))
 
     for epoch in range(initial_epoch, config['num_epochs']):
-        torch.cuda.empty_cache()
         student_model.train()
-        teacher_model.eval()
+        # Reshuffle the batches of a DistributedSampler or BucketBatchSampler
+        for sampler in (train_dataloader.sampler, train_dataloader.batch_sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
 
-        batch_iterator = tqdm(enumerate(train_dataloader), desc=f"Processing Epoch {epoch:02d}")
+        batch_iterator = tqdm(enumerate(train_dataloader), desc=f"Processing Epoch {epoch:02d}", disable=not is_main_process)
         for i, batch in batch_iterator:
-            # Only print shapes for the first batch of each epoch
-            print_shapes = (i == 0)
-            
-            encoder_input = batch['encoder_input'].to(device)
-            decoder_input = batch['decoder_input'].to(device)
-            encoder_mask = batch['encoder_mask'].to(device)
-            decoder_mask = batch['decoder_mask'].to(device)
-            label = batch['label'].to(device)
-
-            with torch.no_grad():
-                teacher_output = teacher_model.encode(encoder_input, encoder_mask, print_shapes=print_shapes)
-                teacher_output = teacher_model.decode(teacher_output, encoder_mask, decoder_input, decoder_mask, print_shapes=print_shapes)
-                teacher_logits = teacher_model.project(teacher_output, print_shapes=print_shapes)
-
-            student_output = student_model.encode(encoder_input, encoder_mask, print_shapes=print_shapes)
-            student_output = student_model.decode(student_output, encoder_mask, decoder_input, decoder_mask, print_shapes=print_shapes)
-            student_logits = student_model.project(student_output, print_shapes=print_shapes)
-
-            loss = knowledge_distillation_loss(student_logits.view(-1, tokenizer_tgt.get_vocab_size()),
-                                               teacher_logits.view(-1, tokenizer_tgt.get_vocab_size()),
-                                               label.view(-1), temperature, alpha)
-            batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
-
-            writer.add_scalar('train loss', loss.item(), global_step)
-            writer.flush()
-
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad(set_to_none=True)
+            encoder_input = batch['encoder_input'].to(device, non_blocking=True)
+            decoder_input = batch['decoder_input'].to(device, non_blocking=True)
+            encoder_mask = batch['encoder_mask'].to(device, non_blocking=True)
+            label = batch['label'].to(device, non_blocking=True)
+            # Padding only ever follows the real tokens, so causal attention alone gives the same outputs on every
+            # non-padding position, and lets scaled_dot_product_attention use its causal kernel
+            decoder_mask = None
+
+            # Gradients are accumulated over accum_steps batches and only all-reduced on the last one.
+            # no_sync has to cover the forward pass too, DDP prepares the reduction during forward
+            sync_gradients = (i + 1) % accum_steps == 0 or i + 1 == len(train_dataloader)
+            sync_context = train_student.no_sync() if distributed and not sync_gradients else contextlib.nullcontext()
+            with sync_context:
+                with amp_context(device, amp_dtype, use_amp):
+                    if teacher_cache is not None:
+                        teacher_logits = batch['teacher_values'].to(device, non_blocking=True)
+                        teacher_indices = batch['teacher_indices'].to(device, non_blocking=True)
+                        teacher_indices = teacher_indices.view(-1, teacher_indices.size(-1))
+                    else:
+                        with torch.no_grad():
+                            teacher_logits = teacher_forward(encoder_input, encoder_mask, decoder_input, decoder_mask)
+                        teacher_indices = None
+
+                    student_logits = student_forward(encoder_input, encoder_mask, decoder_input, decoder_mask)
+
+                    loss = knowledge_distillation_loss(student_logits.view(-1, vocab_tgt_size),
+                                                       teacher_logits.view(-1, teacher_logits.size(-1)),
+                                                       label.view(-1), temperature, alpha, loss_fn, pad_idx, teacher_indices=teacher_indices)
+
+                scaler.scale(loss / accum_steps).backward()
+
+            if is_main_process:
+                batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
+
+                writer.add_scalar('train loss', loss.item(), global_step)
+                writer.flush()
+
+            if sync_gradients:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
             global_step += 1
 
-        run_validation(student_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer)
+        if not is_main_process:
+            continue
+
+        if device.type == 'cuda':
+            batch_iterator.write(f"Peak memory allocated: {torch.cuda.max_memory_allocated(device) / 1024 ** 3:.2f} GB")
+            torch.cuda.reset_peak_memory_stats(device)
+
+        run_validation(student_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer, metrics=metrics)
 
         model_filename = get_weights_file_path(config, f"{epoch:02d}")
         torch.save({
@@ -260,19 +534,26 @@ def train_model(config):
             'global_step': global_step
         }, model_filename)
 
+    if distributed:
+        dist.destroy_process_group()
+    if not is_main_process:
+        return
+
     print(f"Model weights saved to {model_filename}")
 
     # Measure the original model size
     original_model_size = os.path.getsize(model_filename) / (1024 * 1024)
     print(f"Model size after knowledge distillation: {original_model_size:.2f} MB")
 
-    # Apply dynamic quantization to the model
-    student_model = torch.quantization.quantize_dynamic(
-        student_model,  # the model to quantize
-        {nn.Linear},  # layers to apply dynamic quantization to
-        dtype=torch.qint8  # data type for quantized weights
-    )
-    print("Dynamic Quantization applied to the model")
+    if config.get('prune', True):
+        student_model = prune_2_4(student_model)
+        print("2:4 structured pruning applied to the model")
+        # Pruning is not followed by any fine-tuning, so check what it costs before quantizing
+        run_validation(student_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, print, global_step, writer, metrics=metrics, prefix='pruned validation')
+
+    # Apply static quantization to the model, calibrated on the validation set
+    student_model = quantize_static(student_model, val_dataloader)
+    print("Static Quantization applied to the model")
 
     # Save the quantized model
     quantized_model_filename = get_weights_file_path(config, "quantized_model")
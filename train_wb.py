@@ -1,5 +1,5 @@
 from model import build_transformer
-from dataset import BilingualDataset, causal_mask
+from dataset import BilingualDataset, BilingualCollate, causal_mask
 from config import get_config, get_weights_file_path
 
 import torchtext.datasets as datasets
@@ -11,6 +11,7 @@ from torch.optim.lr_scheduler import LambdaLR
 import warnings
 from tqdm import tqdm
 import os
+import shutil
 from pathlib import Path
 
 # Huggingface datasets and tokenizers
@@ -36,11 +37,8 @@ def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_
         if decoder_input.size(1) == max_len:
             break
 
-        # build mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-
-        # calculate output
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
+        # calculate output, without a target mask the decoder applies causal attention itself
+        out = model.decode(encoder_output, source_mask, decoder_input, None)
 
         # get next token
         prob = model.project(out[:, -1])
@@ -63,14 +61,8 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
     expected = []
     predicted = []
 
-    try:
-        # get the console window width
-        with os.popen('stty size', 'r') as console:
-            _, console_width = console.read().split()
-            console_width = int(console_width)
-    except:
-        # If we can't get the console width, use 80 as default
-        console_width = 80
+    # get the console window width, falling back to 80 columns when stdout is not a terminal
+    console_width = shutil.get_terminal_size(fallback=(80, 24)).columns
 
     with torch.no_grad():
         for batch in validation_ds:
@@ -166,8 +158,10 @@ def get_ds(config):
     print(f'Max length of target sentence: {max_len_tgt}')
     
 
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # Tokenize and pad each batch in one go
+    collate_fn = BilingualCollate(tokenizer_src, tokenizer_tgt, config['seq_len'], build_decoder_mask=True)
+    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True, collate_fn=collate_fn)
+    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True, collate_fn=collate_fn)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
@@ -185,6 +179,8 @@ def train_model(config):
 
     train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
     model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The config batch size assumes activation checkpointing
+    model.set_gradient_checkpointing(config.get('gradient_checkpointing', False))
 
     optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9)
 
@@ -210,7 +206,6 @@ def train_model(config):
     wandb.define_metric("train/*", step_metric="global_step")
 
     for epoch in range(initial_epoch, config['num_epochs']):
-        torch.cuda.empty_cache()
         model.train()
         batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}")
         for batch in batch_iterator: